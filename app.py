@@ -1,55 +1,422 @@
+import hmac
+import json
 import os
-from datetime import datetime, timezone, timedelta
-from flask import Flask, request, jsonify
-from threading import Lock
+import queue
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from flask import Flask, g, request, jsonify, Response
+from threading import Lock, Thread
+
+# One pair of json helpers, bound once at import and shared by response
+# serialization and SQLite metadata round-trips.
+try:
+    import orjson
+    _json_bytes = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_bytes(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+    _json_loads = json.loads
+
+try:
+    # The /checkcode success body always has the same shape; a Struct plus a
+    # reusable Encoder serializes it without building an intermediate dict.
+    import msgspec
+
+    class _Ok(msgspec.Struct):
+        status: str = "ok"
+        code: str = ""
+        metadata: dict = {}
+
+    _ok_enc = msgspec.json.Encoder().encode
+
+    def _ok_bytes(code, metadata):
+        return _ok_enc(_Ok(code=code, metadata=metadata))
+except ImportError:
+    def _ok_bytes(code, metadata):
+        return _json_bytes({"status": "ok", "code": code, "metadata": metadata})
 
 app = Flask(__name__)
 
+def _bytes_response(body, status=200):
+    # Preformed body: pin Content-Length and mark direct_passthrough so
+    # Werkzeug emits the bytes as-is without re-iterating or re-measuring.
+    r = Response(body, status, mimetype="application/json", direct_passthrough=True)
+    r.headers["Content-Length"] = str(len(body))
+    return r
+
+def _json_response(payload, status=200):
+    return _bytes_response(_json_bytes(payload), status)
+
+def _iso(ts):
+    # Datetimes exist only at response-format time; everything else works
+    # on int epoch seconds.
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
 # Hardcoded ADMIN_API_KEY
 ADMIN_API_KEY = os.getenv("ADMIN_API_KEY", "f9A7d3!X2vQ#8LmRp6ZyT0wB1uH4eKjS")
 DEFAULT_TTL = int(os.getenv("DEFAULT_TTL_SECONDS", "900"))
 ALLOW_REUSE = os.getenv("ALLOW_REUSE", "0") == "1"
+USE_SQLITE = os.getenv("USE_SQLITE", "0") == "1"
+DB_PATH = os.getenv("CODES_DB", "codes.db")
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))
+# With the whole DB mmap-ed and a page cache sized for the working set,
+# warm SELECTs resolve from memory without a read syscall.
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "131072"))
+PURGE_INTERVAL = int(os.getenv("PURGE_INTERVAL_SECONDS", "60"))
+
+# SQLite purge deletes in bounded batches so cleanup never holds the write
+# lock long enough to stall live /checkcode traffic.
+_PURGE_BATCH = 4096
+
+_ADMIN_KEY_B = ADMIN_API_KEY.encode("ascii") if ADMIN_API_KEY else b""
+
+_EMPTY = {}
+
+# Reject junk before it reaches the store: a code is 1-128 chars from a
+# fixed charset, so oversized or binary payloads cost one failed match
+# instead of hashing/binding megabytes.
+_CODE_RE = re.compile(rb"[A-Za-z0-9_\-]{1,128}")
+
+# LRU negative cache: codes that recently missed the store short-circuit to
+# the 404 without touching it again. Bots hammering a small set of garbage
+# values hit this dict instead of the backend. Relies on the same dict-op
+# atomicity as the store itself - no lock.
+_neg = OrderedDict()
+_NEG_MAX = 4096
+
+# Error bodies never change, so build the Response objects once at import
+# instead of running jsonify/json.dumps on every miss.
+_ERR_MISSING = _bytes_response(b'{"status":"error","error":"missing_code"}', 400)
+_ERR_INVALID = _bytes_response(b'{"status":"error","error":"invalid_or_expired"}', 404)
+_ERR_UNAUTHORIZED = _bytes_response(b'{"status":"error","error":"unauthorized"}', 401)
+
+class MemoryStore:
+    # Entries are (expires_at, metadata) tuples and "used" is expressed by
+    # deleting the key: dict operations are atomic under the GIL and pop()
+    # guarantees a single winner among racing consumers, so the consume
+    # path needs no lock at all. This supersedes the earlier sharded-lock
+    # layout - with no locks there is nothing left to shard.
+    def __init__(self):
+        self._codes = {}
+        # Bind the hot dict methods once so consume does one attribute load
+        # instead of a dict attribute walk plus method lookup per call.
+        self._pop = self._codes.pop
+        self._get = self._codes.get
+
+    def add(self, code, ttl_seconds, metadata, now_ts=None):
+        expires_at = (now_ts if now_ts is not None else int(time.time())) + ttl_seconds
+        self._codes[code] = (expires_at, metadata)
+        return expires_at
+
+    def check_and_consume(self, code, allow_reuse=False, now_ts=None):
+        if allow_reuse:
+            entry = self._get(code)
+        else:
+            entry = self._pop(code, None)
+        if entry is None:
+            return None, "not_found"
+        if entry[0] < (now_ts if now_ts is not None else int(time.time())):
+            return None, "expired"
+        return {"code": code, "metadata": entry[1]}, None
+
+    def purge(self):
+        removed = 0
+        now_i = int(time.time())
+        codes = self._codes
+        # Snapshot with list() so concurrent add/pop can't change the dict
+        # size mid-iteration; pop() tolerates entries consumed in between.
+        for code, entry in list(codes.items()):
+            if entry[0] < now_i and codes.pop(code, None) is not None:
+                removed += 1
+        return removed
+
+class SQLiteStore:
+    # Persistent backend. Connections are opened once and reused for the
+    # process lifetime - opening per request re-reads the schema and
+    # renegotiates the journal mode every time. The layout mirrors SQLite's
+    # own concurrency model: one writer connection used serially under a
+    # lock, plus a pool of reader connections that WAL lets run without
+    # blocking on the writer.
+    # Inserts are funneled through one background thread that flushes whole
+    # batches with a single commit: the WAL fsync is the write-throughput
+    # ceiling, and batching amortizes it across every row queued while the
+    # previous fsync was in flight.
+    _WRITE_BATCH = 500
+
+    def __init__(self, path, pool_size=SQLITE_POOL_SIZE):
+        self.path = path
+        self._writer = self._new_conn()
+        self._writer_lock = Lock()
+        self._init_db()
+        self._readers = queue.Queue()
+        for _ in range(pool_size):
+            self._readers.put(self._new_conn())
+        self._write_q = queue.Queue()
+        Thread(target=self._writer_loop, daemon=True).start()
 
-_codes = {}
-_lock = Lock()
+    def _new_conn(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            "PRAGMA busy_timeout=5000;"
+            "PRAGMA temp_store=MEMORY;"
+            "PRAGMA cache_size=-%d;"
+            "PRAGMA mmap_size=%d;" % (SQLITE_CACHE_KB, SQLITE_MMAP_SIZE)
+        )
+        return conn
 
-def now():
-    return datetime.now(timezone.utc)
+    @contextmanager
+    def _reader(self):
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    # WITHOUT ROWID keeps the row payload in the primary-key B-tree leaf:
+    # one probe per lookup instead of key index + rowid table.
+    # code is a BLOB: the handlers pass bytes, so binding skips the per-call
+    # UTF-8 encode a TEXT column would do and comparison is plain memcmp.
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS codes ("
+        " code BLOB PRIMARY KEY,"
+        " expires_at INTEGER NOT NULL,"
+        " used INTEGER NOT NULL DEFAULT 0,"
+        " metadata TEXT) WITHOUT ROWID"
+    )
+
+    def _init_db(self):
+        with self._writer_lock:
+            conn = self._writer
+            row = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE type='table' AND name='codes'"
+            ).fetchone()
+            if row and ("WITHOUT ROWID" not in row[0] or "code BLOB" not in row[0]):
+                # Rebuild a legacy (rowid or TEXT-keyed) table into the new
+                # layout once at startup.
+                conn.execute("DROP INDEX IF EXISTS ix_codes_exp_live")
+                conn.execute("ALTER TABLE codes RENAME TO codes_old")
+                conn.execute(self._SCHEMA)
+                conn.execute(
+                    "INSERT INTO codes"
+                    " SELECT CAST(code AS BLOB), expires_at, used, metadata FROM codes_old"
+                )
+                conn.execute("DROP TABLE codes_old")
+            else:
+                conn.execute(self._SCHEMA)
+            conn.execute("DROP INDEX IF EXISTS ix_codes_gc")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_codes_exp_live"
+                " ON codes(expires_at) WHERE used=0"
+            )
+            conn.commit()
+
+    def _writer_loop(self):
+        q = self._write_q
+        while True:
+            batch = [q.get()]
+            while len(batch) < self._WRITE_BATCH:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self._writer_lock:
+                    self._writer.executemany(
+                        "REPLACE INTO codes (code, expires_at, used, metadata)"
+                        " VALUES (?, ?, 0, ?)",
+                        [row for row, _ in batch],
+                    )
+                    self._writer.commit()
+            except Exception as exc:
+                for _, fut in batch:
+                    fut.set_exception(exc)
+                continue
+            for _, fut in batch:
+                fut.set_result(None)
+
+    def add(self, code, ttl_seconds, metadata, now_ts=None):
+        expires_at = (now_ts if now_ts is not None else int(time.time())) + ttl_seconds
+        fut = Future()
+        self._write_q.put(((code, expires_at, _json_bytes(metadata)), fut))
+        fut.result(timeout=1.0)
+        return expires_at
+
+    def check_and_consume(self, code, allow_reuse=False, now_ts=None):
+        now_i = now_ts if now_ts is not None else int(time.time())
+        if allow_reuse:
+            with self._reader() as conn:
+                row = conn.execute(
+                    "SELECT metadata FROM codes WHERE code=? AND expires_at>=?",
+                    (code, now_i),
+                ).fetchone()
+        else:
+            # One statement instead of SELECT + UPDATE: the WHERE clause
+            # does the expiry/used checks and RETURNING hands back the row,
+            # so consuming a code is a single round-trip on the writer.
+            with self._writer_lock:
+                row = self._writer.execute(
+                    "UPDATE codes SET used=1"
+                    " WHERE code=? AND used=0 AND expires_at>=? RETURNING metadata",
+                    (code, now_i),
+                ).fetchone()
+                self._writer.commit()
+        if row is None:
+            return None, "not_found"
+        return {"code": code, "metadata": _json_loads(row[0]) if row[0] else {}}, None
+
+    def purge(self):
+        removed = 0
+        now_i = int(time.time())
+        # Two passes so the expired scan can use the partial index on live
+        # rows; used rows are swept separately.
+        for cond, params in (
+            ("used=0 AND expires_at < ?", (now_i, _PURGE_BATCH)),
+            ("used=1", (_PURGE_BATCH,)),
+        ):
+            while True:
+                # Re-take the writer lock per batch so consumes interleave.
+                with self._writer_lock:
+                    cur = self._writer.execute(
+                        "DELETE FROM codes WHERE code IN"
+                        " (SELECT code FROM codes WHERE " + cond + " LIMIT ?)",
+                        params,
+                    )
+                    self._writer.commit()
+                removed += cur.rowcount
+                if cur.rowcount < _PURGE_BATCH:
+                    break
+        return removed
+
+store = SQLiteStore(DB_PATH) if USE_SQLITE else MemoryStore()
+
+def _purge_loop():
+    while True:
+        time.sleep(PURGE_INTERVAL)
+        try:
+            store.purge()
+        except Exception:
+            app.logger.exception("purge failed")
+
+Thread(target=_purge_loop, daemon=True).start()
+
+@app.before_request
+def _stamp_request():
+    # One clock read per request; handlers and stores share it instead of
+    # each calling time.time() again.
+    g.now_ts = int(time.time())
+
+_HEALTH_BODY = b'{"status":"ok"}'
+_HEALTH_HEADERS = [
+    ("Content-Type", "application/json"),
+    ("Content-Length", str(len(_HEALTH_BODY))),
+]
+
+class HealthShortcut:
+    # Load balancers poll /health constantly; answer at the WSGI layer so
+    # those hits skip routing, request-context setup and jsonify entirely.
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") == "/health":
+            method = environ.get("REQUEST_METHOD")
+            if method == "GET":
+                start_response("200 OK", _HEALTH_HEADERS)
+                return [_HEALTH_BODY]
+            if method == "HEAD":
+                # Same pinned headers, empty body - LB probes often use HEAD.
+                start_response("200 OK", _HEALTH_HEADERS)
+                return [b""]
+        return self.wsgi_app(environ, start_response)
 
 @app.get("/health")
 def health():
-    return jsonify({"status": "ok", "time": now().isoformat()})
+    # Backstop for anything the WSGI shortcut doesn't answer (e.g. OPTIONS
+    # via Flask's automatic handling); GET/HEAD never reach this route.
+    return _bytes_response(_HEALTH_BODY)
+
+_NO_CONTENT = Response(b"", 204)
+
+@app.after_request
+def _cors(resp):
+    # Fixed CORS headers; flask_cors would run origin regex matching on
+    # every response for the same result.
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    resp.headers["Access-Control-Allow-Headers"] = "X-API-KEY,Content-Type"
+    return resp
+
+@app.route("/addcode", methods=["OPTIONS"])
+@app.route("/checkcode", methods=["OPTIONS"])
+def preflight():
+    return _NO_CONTENT
+
+@app.get("/health/detailed")
+def health_detailed():
+    return jsonify({"status": "ok", "time": g.now_ts})
+
+def require_api_key():
+    # compare_digest on the pre-encoded key: constant-time, and no
+    # re-encoding of the configured key per request.
+    hdr = request.headers.get("X-API-KEY", "").encode("latin-1", "replace")
+    if not _ADMIN_KEY_B or not hmac.compare_digest(hdr, _ADMIN_KEY_B):
+        return _ERR_UNAUTHORIZED
+    return None
 
 @app.post("/addcode")
 def addcode():
-    if not ADMIN_API_KEY or request.headers.get("X-API-KEY") != ADMIN_API_KEY:
-        return jsonify({"status": "error", "error": "unauthorized"}), 401
-    j = request.get_json(silent=True) or {}
-    code = (j.get("code") or "").strip()
-    if not code:
-        return jsonify({"status":"error","error":"missing_code"}), 400
+    err = require_api_key()
+    if err is not None:
+        return err
+    j = request.get_json(silent=True) or _EMPTY
+    # Codes are ASCII by construction; working on bytes end to end saves the
+    # UTF-8 encode both the dict hash and the SQLite bind would otherwise do.
+    code = (j.get("code") or "").strip().encode("ascii", "ignore")
+    if not _CODE_RE.fullmatch(code):
+        return _ERR_MISSING
     ttl = int(j.get("ttl_seconds") or DEFAULT_TTL)
-    exp = now() + timedelta(seconds=ttl)
-    with _lock:
-        _codes[code] = {"expires_at": exp, "used": False, "metadata": j.get("metadata") or {}}
-    return jsonify({"status": "added", "code": code, "expires_at": exp.isoformat()})
+    expires_at = store.add(code, ttl, j.get("metadata") or {}, now_ts=g.now_ts)
+    _neg.pop(code, None)
+    return _json_response(
+        {"status": "added", "code": code.decode("ascii"), "expires_at": _iso(expires_at)})
 
 @app.route("/checkcode", methods=["GET","POST"])
 def checkcode():
-    code = (request.args.get("code") or (request.get_json(silent=True) or {}).get("code") or "").strip()
-    if not code:
-        return jsonify({"status":"error","error":"missing_code"}), 400
-    with _lock:
-        e = _codes.get(code)
-        if not e: return jsonify({"status":"error","error":"invalid_or_expired"}), 404
-        if e["expires_at"] < now(): return jsonify({"status":"error","error":"invalid_or_expired"}), 404
-        if e["used"] and not ALLOW_REUSE: return jsonify({"status":"error","error":"invalid_or_expired"}), 404
-        e["used"] = True
-        return jsonify({"status": "ok", "code": code, "metadata": e.get("metadata", {})})
+    # GET requests carry the code in the query string - skip the JSON body
+    # parse (and its Content-Type sniffing) entirely for those.
+    if request.method == "GET":
+        code = (request.args.get("code") or "").strip().encode("ascii", "ignore")
+    else:
+        code = ((request.get_json(silent=True) or _EMPTY).get("code") or "") \
+            .strip().encode("ascii", "ignore")
+    if not _CODE_RE.fullmatch(code):
+        return _ERR_MISSING
+    if code in _neg:
+        return _ERR_INVALID
+    result, err = store.check_and_consume(code, ALLOW_REUSE, now_ts=g.now_ts)
+    if err:
+        _neg[code] = None
+        _neg.move_to_end(code)
+        if len(_neg) > _NEG_MAX:
+            _neg.popitem(last=False)
+        return _ERR_INVALID
+    return _bytes_response(_ok_bytes(code.decode("ascii"), result["metadata"]))
 @app.get("/")
 def index():
     return jsonify({"message": "API running", "endpoints": ["/health", "/addcode", "/checkcode"]})
 
+app.wsgi_app = HealthShortcut(app.wsgi_app)
+
 if __name__ == "__main__":
+    # Dev convenience only - in production run under gunicorn with keepalive, e.g.
+    #   gunicorn -k gthread --threads 8 --workers $(nproc) --keep-alive 30 app:app
     port = int(os.getenv("PORT", "8080"))
     app.run(host="0.0.0.0", port=port)